@@ -0,0 +1,8 @@
+import asyncio
+
+# Use uvloop when available so every entry point (not just uvicorn) gets the faster loop
+try:
+    import uvloop
+    asyncio.set_event_loop_policy(uvloop.EventLoopPolicy())
+except ImportError:
+    pass
@@ -1,4 +1,5 @@
 import os
+from functools import lru_cache
 from dotenv import load_dotenv
 
 load_dotenv()
@@ -6,16 +7,21 @@ load_dotenv()
 class Config:
     PARALONCLOUD_API_KEY = os.getenv("PARALONCLOUD_API_KEY")
     PARALONCLOUD_API_BASE = os.getenv("PARALONCLOUD_API_BASE", "https://paraloncloud.com/v1")
+    # Maximum number of generation requests in flight to the API at once
+    PARALONCLOUD_MAX_CONCURRENCY = int(os.getenv("PARALONCLOUD_MAX_CONCURRENCY", "20"))
     
     # File paths
     UPLOAD_DIR = "uploads"
     GENERATED_DIR = "generated"
     
-    # Create directories if they don't exist
-    os.makedirs(UPLOAD_DIR, exist_ok=True)
-    os.makedirs(GENERATED_DIR, exist_ok=True)
+    @classmethod
+    def ensure_dirs(cls):
+        """Create the upload and output directories if they don't exist (called once on startup)"""
+        os.makedirs(cls.UPLOAD_DIR, exist_ok=True)
+        os.makedirs(cls.GENERATED_DIR, exist_ok=True)
     
     @classmethod
+    @lru_cache(maxsize=1)
     def validate(cls):
         if not cls.PARALONCLOUD_API_KEY:
             raise ValueError("PARALONCLOUD_API_KEY not found in environment variables")
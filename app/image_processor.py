@@ -1,35 +1,51 @@
 import os
+import shutil
 import httpx
 import aiofiles
 from PIL import Image
 import numpy as np
+import cv2
 from app.config import Config
 
 class ImageProcessor:
     """Utility class for image processing operations"""
     
     @staticmethod
-    async def download_image(url: str, save_path: str) -> str:
-        """Download an image from a URL and save it locally"""
+    async def download_image(client: httpx.AsyncClient, url: str, save_path: str) -> str:
+        """Download an image from a URL and save it locally using a shared HTTP client"""
         try:
             # Ensure directory exists
             dir_path = os.path.dirname(save_path)
             if dir_path:
                 os.makedirs(dir_path, exist_ok=True)
             
-            async with httpx.AsyncClient(timeout=30.0) as client:
-                response = await client.get(url)
+            # Stream the body to disk instead of buffering the whole image in memory
+            async with client.stream("GET", url) as response:
                 response.raise_for_status()
                 
                 async with aiofiles.open(save_path, 'wb') as f:
-                    await f.write(response.content)
-                
-                return save_path
+                    async for chunk in response.aiter_bytes(chunk_size=64 * 1024):
+                        await f.write(chunk)
+            
+            return save_path
         except Exception as e:
+            # Don't leave a truncated image behind if the stream failed partway
+            if os.path.exists(save_path):
+                os.remove(save_path)
             raise Exception(f"Failed to download image from {url}: {str(e)}")
     
     @staticmethod
-    def apply_style_transfer(base_image_path: str, style_image_path: str, output_path: str, alpha: float = 0.5):
+    def _read_bgr(image_path: str):
+        """Decode an image to a contiguous uint8 BGR array (3 channels, alpha dropped)"""
+        array = cv2.imread(image_path, cv2.IMREAD_COLOR)
+        if array is None:
+            # OpenCV lacks some decoders Pillow has (e.g. GIF before 4.11)
+            with Image.open(image_path) as img:
+                array = np.ascontiguousarray(np.asarray(img.convert("RGB"))[..., ::-1])
+        return array
+    
+    @staticmethod
+    def apply_style_transfer(base_image_path: str, style_image_path: str, output_path: str, alpha: float = 0.5, resample=None):
         """
         Apply a simple style transfer by blending images
         
@@ -38,24 +54,39 @@ class ImageProcessor:
             style_image_path: Path to the style reference image
             output_path: Path to save the result
             alpha: Blending factor (0.0 to 1.0)
+            resample: OpenCV interpolation flag for the style image; defaults to
+                INTER_LANCZOS4 when alpha >= 0.5 and INTER_LINEAR otherwise, since
+                fine detail is mostly washed out at low blend weights
         """
-        base_img = Image.open(base_image_path).convert("RGB")
-        style_img = Image.open(style_image_path).convert("RGB")
+        base_array = ImageProcessor._read_bgr(base_image_path)
+        style_array = ImageProcessor._read_bgr(style_image_path)
         
-        # Resize style image to match base image
-        style_img = style_img.resize(base_img.size, Image.Resampling.LANCZOS)
+        height, width = base_array.shape[:2]
         
-        # Convert to numpy arrays
-        base_array = np.array(base_img, dtype=np.float32)
-        style_array = np.array(style_img, dtype=np.float32)
+        # Resize style image to match base image (skipped when sizes already agree)
+        if style_array.shape[:2] != (height, width):
+            if resample is None:
+                resample = cv2.INTER_LANCZOS4 if alpha >= 0.5 else cv2.INTER_LINEAR
+            
+            # Large integer downscales go through a box-filter reduce first
+            if resample == cv2.INTER_LINEAR:
+                style_height, style_width = style_array.shape[:2]
+                factor = min(style_width // width, style_height // height)
+                if factor >= 2:
+                    style_array = cv2.resize(
+                        style_array,
+                        (style_width // factor, style_height // factor),
+                        interpolation=cv2.INTER_AREA
+                    )
+            
+            style_array = cv2.resize(style_array, (width, height), interpolation=resample)
         
-        # Blend images
-        blended = (1 - alpha) * base_array + alpha * style_array
-        blended = np.clip(blended, 0, 255).astype(np.uint8)
+        # Blend images in a single saturating uint8 pass into one preallocated buffer
+        blended = np.empty(base_array.shape, dtype=np.uint8)
+        cv2.addWeighted(base_array, 1.0 - alpha, style_array, alpha, 0.0, dst=blended)
         
-        # Save result
-        result_img = Image.fromarray(blended)
-        result_img.save(output_path)
+        # Save result (already BGR, which is what imwrite expects)
+        cv2.imwrite(output_path, blended)
         return output_path
     
     @staticmethod
@@ -69,6 +100,11 @@ class ImageProcessor:
     @staticmethod
     def convert_format(image_path: str, output_path: str, format: str = "PNG"):
         """Convert image to a different format"""
-        img = Image.open(image_path)
-        img.save(output_path, format=format)
+        with Image.open(image_path) as img:
+            # Already in the target format: copy the bytes instead of decoding and re-encoding
+            if img.format == format.upper():
+                if os.path.abspath(image_path) != os.path.abspath(output_path):
+                    shutil.copyfile(image_path, output_path)
+                return output_path
+            img.save(output_path, format=format)
         return output_path
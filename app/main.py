@@ -1,24 +1,65 @@
 from fastapi import FastAPI, File, UploadFile, Form, HTTPException
 from fastapi.middleware.cors import CORSMiddleware
 from fastapi.staticfiles import StaticFiles
-from fastapi.responses import FileResponse, JSONResponse
+from fastapi.responses import FileResponse, JSONResponse, ORJSONResponse
 import os
 import uuid
+import hashlib
+import asyncio
 import logging
-import traceback
+from contextlib import asynccontextmanager
 from typing import Optional
 import aiofiles
 import base64
+import httpx
 
 from app.config import Config
-from app.paralon_client import ParalonClient
+from app.paralon_client import get_client
 from app.image_processor import ImageProcessor
 
 # Configure logging
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 
-app = FastAPI(title="ParalonCloud Image Generation & Editing Tool")
+# Upper bound on simultaneous result downloads (also the HTTP pool size)
+MAX_CONCURRENT_DOWNLOADS = 100
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    """Create shared resources on startup and release them on shutdown"""
+    Config.ensure_dirs()
+    
+    # One pooled client for all image downloads so they share keep-alive connections
+    app.state.http = httpx.AsyncClient(
+        timeout=30.0,
+        limits=httpx.Limits(max_connections=MAX_CONCURRENT_DOWNLOADS, max_keepalive_connections=50),
+        http2=True
+    )
+    # Bounds in-flight downloads across all requests to the size of the pool
+    app.state.dl_sem = asyncio.Semaphore(MAX_CONCURRENT_DOWNLOADS)
+    
+    # API client is built per startup (and closed on shutdown) so it never outlives its loop
+    try:
+        app.state.paralon_client = get_client()
+        logger.info("Clients initialized successfully")
+    except Exception as e:
+        logger.exception("Failed to initialize clients: %s", e)
+        app.state.paralon_client = None
+    
+    try:
+        if app.state.paralon_client:
+            app.state.paralon_client.schedule_warmup()
+        yield
+    finally:
+        await app.state.http.aclose()
+        if app.state.paralon_client:
+            await app.state.paralon_client.close()
+
+app = FastAPI(
+    title="ParalonCloud Image Generation & Editing Tool",
+    default_response_class=ORJSONResponse,
+    lifespan=lifespan
+)
 
 # CORS middleware
 app.add_middleware(
@@ -29,20 +70,79 @@ app.add_middleware(
     allow_headers=["*"],
 )
 
-# Mount static directories
-app.mount("/uploads", StaticFiles(directory=Config.UPLOAD_DIR), name="uploads")
-app.mount("/generated", StaticFiles(directory=Config.GENERATED_DIR), name="generated")
+# Mount static directories (created by Config.ensure_dirs() in the lifespan handler)
+app.mount("/uploads", StaticFiles(directory=Config.UPLOAD_DIR, check_dir=False), name="uploads")
+app.mount("/generated", StaticFiles(directory=Config.GENERATED_DIR, check_dir=False), name="generated")
 
-# Initialize clients (with error handling)
-try:
-    paralon_client = ParalonClient()
-    image_processor = ImageProcessor()
-    logger.info("Clients initialized successfully")
-except Exception as e:
-    logger.error(f"Failed to initialize clients: {str(e)}")
-    logger.error(traceback.format_exc())
-    paralon_client = None
-    image_processor = None
+def _write_bytes(path: str, data: bytes):
+    """Write a complete payload to disk in one call (run via asyncio.to_thread)"""
+    with open(path, 'wb') as f:
+        f.write(data)
+
+def _decode_and_write(b64_data: str, path: str):
+    """Decode a base64 image and write it to disk (run via asyncio.to_thread)"""
+    # Decode first so invalid input doesn't leave an empty file behind
+    data = base64.b64decode(b64_data)
+    with open(path, 'wb') as f:
+        f.write(data)
+
+async def _spool_upload(upload: UploadFile, chunk_size: int = 64 * 1024) -> str:
+    """
+    Copy an uploaded file to disk in fixed-size chunks to keep memory flat.
+    
+    Files are stored under a digest of their content, so re-uploading the same
+    image reuses the existing copy instead of writing a duplicate.
+    """
+    hasher = hashlib.blake2b(digest_size=8)
+    tmp_path = os.path.join(Config.UPLOAD_DIR, f"{uuid.uuid4()}.part")
+    try:
+        async with aiofiles.open(tmp_path, 'wb') as f:
+            while chunk := await upload.read(chunk_size):
+                hasher.update(chunk)
+                await f.write(chunk)
+    except BaseException:
+        # Don't leave partial spools behind (e.g. client disconnected mid-upload)
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        raise
+    
+    ext = os.path.splitext(upload.filename or "")[1].lower()
+    path = os.path.join(Config.UPLOAD_DIR, f"{hasher.hexdigest()}{ext}")
+    if os.path.exists(path):
+        os.remove(tmp_path)
+    else:
+        os.replace(tmp_path, path)
+    return path
+
+async def _save_result(img_data) -> str:
+    """Persist one API result (URL, base64 string or raw bytes) and return its public path"""
+    filename = f"{uuid.uuid4()}.png"
+    save_path = os.path.join(Config.GENERATED_DIR, filename)
+    
+    # Handle both URL strings and base64 encoded images
+    if isinstance(img_data, str):
+        if img_data.startswith('http://') or img_data.startswith('https://'):
+            async with app.state.dl_sem:
+                await image_processor.download_image(app.state.http, img_data, save_path)
+        else:
+            # It's base64 encoded
+            try:
+                await asyncio.to_thread(_decode_and_write, img_data, save_path)
+            except Exception as e:
+                logger.error("Error decoding base64 image: %s", e)
+                raise HTTPException(status_code=500, detail=f"Error processing image: {str(e)}")
+    else:
+        # Assume it's already bytes or a file-like object
+        payload = img_data if isinstance(img_data, bytes) else str(img_data).encode()
+        await asyncio.to_thread(_write_bytes, save_path, payload)
+    
+    return f"/generated/{filename}"
+
+async def _fanout_download(image_data: list) -> list:
+    """Save all API results concurrently, returning public paths in the same order"""
+    return list(await asyncio.gather(*(_save_result(img_data) for img_data in image_data)))
+
+image_processor = ImageProcessor()
 
 @app.get("/")
 async def root():
@@ -50,8 +150,8 @@ async def root():
     return {
         "status": "ok", 
         "message": "ParalonCloud Image Generation & Editing Tool API",
-        "client_initialized": paralon_client is not None,
-        "api_base": Config.PARALONCLOUD_API_BASE if paralon_client else None
+        "client_initialized": app.state.paralon_client is not None,
+        "api_base": Config.PARALONCLOUD_API_BASE if app.state.paralon_client else None
     }
 
 @app.get("/api/health")
@@ -59,7 +159,7 @@ async def health_check():
     """Detailed health check"""
     health = {
         "status": "ok",
-        "client_initialized": paralon_client is not None,
+        "client_initialized": app.state.paralon_client is not None,
         "api_key_set": bool(Config.PARALONCLOUD_API_KEY),
         "api_base": Config.PARALONCLOUD_API_BASE,
         "upload_dir_exists": os.path.exists(Config.UPLOAD_DIR),
@@ -74,9 +174,7 @@ async def health_check():
 @app.get("/api/test-endpoints")
 async def test_endpoints():
     """Test which ParalonCloud endpoints are available"""
-    import httpx
-    
-    if not paralon_client:
+    if not app.state.paralon_client:
         raise HTTPException(status_code=500, detail="ParalonCloud client not initialized")
     
     base_url = Config.PARALONCLOUD_API_BASE.rstrip('/')
@@ -126,58 +224,36 @@ async def generate_image(
     model: str = Form("dall-e-3"),
     size: str = Form("1024x1024"),
     quality: str = Form("standard"),
-    n: int = Form(1)
+    n: int = Form(1),
+    bypass_cache: bool = Form(False)
 ):
     """
     Generate an image from a text prompt
+    
+    Identical requests are served from a short-lived cache; set bypass_cache to
+    force a fresh generation.
     """
-    if not paralon_client:
+    if not app.state.paralon_client:
         raise HTTPException(status_code=500, detail="ParalonCloud client not initialized. Check your API key in .env file.")
     
     try:
-        logger.info(f"Generating image with prompt: {prompt[:50]}...")
-        image_data = await paralon_client.generate_image(
+        logger.info("Generating image with prompt: %s...", prompt[:50])
+        image_data = await app.state.paralon_client.generate_image(
             prompt=prompt,
             model=model,
             size=size,
             quality=quality,
-            n=n
+            n=n,
+            bypass_cache=bypass_cache
         )
         
         if not image_data:
             raise HTTPException(status_code=500, detail="No images returned from API")
         
         # Download and save images locally
-        saved_paths = []
-        for i, img_data in enumerate(image_data):
-            filename = f"{uuid.uuid4()}.png"
-            save_path = os.path.join(Config.GENERATED_DIR, filename)
-            
-            # Handle both URL strings and base64 encoded images
-            if isinstance(img_data, str):
-                if img_data.startswith('http://') or img_data.startswith('https://'):
-                    # It's a URL
-                    await image_processor.download_image(img_data, save_path)
-                else:
-                    # It's base64 encoded
-                    try:
-                        image_bytes = base64.b64decode(img_data)
-                        async with aiofiles.open(save_path, 'wb') as f:
-                            await f.write(image_bytes)
-                    except Exception as e:
-                        logger.error(f"Error decoding base64 image: {str(e)}")
-                        raise HTTPException(status_code=500, detail=f"Error processing image: {str(e)}")
-            else:
-                # Assume it's already bytes or a file-like object
-                async with aiofiles.open(save_path, 'wb') as f:
-                    if isinstance(img_data, bytes):
-                        await f.write(img_data)
-                    else:
-                        await f.write(str(img_data).encode())
-            
-            saved_paths.append(f"/generated/{filename}")
+        saved_paths = await _fanout_download(image_data)
         
-        logger.info(f"Successfully generated {len(saved_paths)} image(s)")
+        logger.info("Successfully generated %d image(s)", len(saved_paths))
         return {
             "success": True,
             "images": saved_paths,
@@ -186,8 +262,7 @@ async def generate_image(
     except HTTPException:
         raise
     except Exception as e:
-        logger.error(f"Error generating image: {str(e)}")
-        logger.error(traceback.format_exc())
+        logger.exception("Error generating image: %s", e)
         raise HTTPException(status_code=500, detail=f"Error generating image: {str(e)}")
 
 @app.post("/api/edit")
@@ -204,24 +279,15 @@ async def edit_image(
     """
     try:
         # Save uploaded image
-        image_filename = f"{uuid.uuid4()}_{image.filename}"
-        image_path = os.path.join(Config.UPLOAD_DIR, image_filename)
-        
-        async with aiofiles.open(image_path, 'wb') as f:
-            content = await image.read()
-            await f.write(content)
+        image_path = await _spool_upload(image)
         
         # Save mask if provided
         mask_path = None
         if mask:
-            mask_filename = f"{uuid.uuid4()}_{mask.filename}"
-            mask_path = os.path.join(Config.UPLOAD_DIR, mask_filename)
-            async with aiofiles.open(mask_path, 'wb') as f:
-                content = await mask.read()
-                await f.write(content)
+            mask_path = await _spool_upload(mask)
         
         # Edit image
-        image_urls = await paralon_client.edit_image(
+        image_urls = await app.state.paralon_client.edit_image(
             image_path=image_path,
             prompt=prompt,
             mask_path=mask_path,
@@ -231,12 +297,7 @@ async def edit_image(
         )
         
         # Download and save edited images
-        saved_paths = []
-        for i, url in enumerate(image_urls):
-            filename = f"{uuid.uuid4()}.png"
-            save_path = os.path.join(Config.GENERATED_DIR, filename)
-            await image_processor.download_image(url, save_path)
-            saved_paths.append(f"/generated/{filename}")
+        saved_paths = await _fanout_download(image_urls)
         
         return {
             "success": True,
@@ -258,15 +319,10 @@ async def create_variation(
     """
     try:
         # Save uploaded image
-        image_filename = f"{uuid.uuid4()}_{image.filename}"
-        image_path = os.path.join(Config.UPLOAD_DIR, image_filename)
-        
-        async with aiofiles.open(image_path, 'wb') as f:
-            content = await image.read()
-            await f.write(content)
+        image_path = await _spool_upload(image)
         
         # Create variations
-        image_urls = await paralon_client.create_variation(
+        image_urls = await app.state.paralon_client.create_variation(
             image_path=image_path,
             model=model,
             size=size,
@@ -274,12 +330,7 @@ async def create_variation(
         )
         
         # Download and save variation images
-        saved_paths = []
-        for i, url in enumerate(image_urls):
-            filename = f"{uuid.uuid4()}.png"
-            save_path = os.path.join(Config.GENERATED_DIR, filename)
-            await image_processor.download_image(url, save_path)
-            saved_paths.append(f"/generated/{filename}")
+        saved_paths = await _fanout_download(image_urls)
         
         return {
             "success": True,
@@ -300,19 +351,8 @@ async def style_transfer(
     """
     try:
         # Save uploaded images
-        base_filename = f"{uuid.uuid4()}_{base_image.filename}"
-        base_path = os.path.join(Config.UPLOAD_DIR, base_filename)
-        
-        style_filename = f"{uuid.uuid4()}_{style_image.filename}"
-        style_path = os.path.join(Config.UPLOAD_DIR, style_filename)
-        
-        async with aiofiles.open(base_path, 'wb') as f:
-            content = await base_image.read()
-            await f.write(content)
-        
-        async with aiofiles.open(style_path, 'wb') as f:
-            content = await style_image.read()
-            await f.write(content)
+        base_path = await _spool_upload(base_image)
+        style_path = await _spool_upload(style_image)
         
         # Apply style transfer
         output_filename = f"{uuid.uuid4()}.png"
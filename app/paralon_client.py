@@ -1,29 +1,116 @@
 import os
+import time
+import random
 import asyncio
+from collections import OrderedDict
+from typing import Optional
 import httpx
-from openai import OpenAI
+import aiofiles
+import orjson
+from openai import AsyncOpenAI
 from app.config import Config
 
+class TransientAPIError(Exception):
+    """Upstream was unreachable or still rate-limited/unavailable after retries"""
+
 class ParalonClient:
     """Client for interacting with ParalonCloud's OpenAI-compatible API"""
     
+    # Responses that mean "try the next endpoint variant" rather than a hard failure
+    FAILOVER_STATUS_CODES = (404,)
+    # Rate-limit and transient server responses, retried with backoff at the same endpoint
+    RETRY_STATUS_CODES = (429, 502, 503, 504)
+    RETRY_ATTEMPTS = 3
+    RETRY_MAX_DELAY = 30.0
+    
     def __init__(self):
         Config.validate()
         self.api_key = Config.PARALONCLOUD_API_KEY
         self.base_url = Config.PARALONCLOUD_API_BASE.rstrip('/')
         
-        # Try OpenAI client first, but we'll also support direct HTTP calls
-        try:
-            self.client = OpenAI(
-                api_key=self.api_key,
-                base_url=self.base_url
+        # Try different endpoint variations for ParalonCloud
+        # Note: ParalonCloud may use different endpoints than standard OpenAI
+        self._endpoints = tuple(f"{self.base_url}{path}" for path in (
+            "/images/generations",  # Standard OpenAI format
+            "/inference/images/generations",  # ParalonCloud inference endpoint
+            "/inference/generate",  # Alternative inference format
+            "/generate",  # Simple format
+            "/v1/generate",  # Versioned simple format
+            "/api/v1/images/generations",  # API prefix format
+        ))
+        
+        # OpenAI SDK client for the multipart edit and variation endpoints
+        self.client = AsyncOpenAI(
+            api_key=self.api_key,
+            base_url=self.base_url,
+            # HTTP/2 so concurrent SDK calls multiplex over one connection
+            http_client=httpx.AsyncClient(
+                http2=True,
+                limits=httpx.Limits(max_connections=Config.PARALONCLOUD_MAX_CONCURRENCY)
             )
-            self.use_openai_client = True
-        except Exception:
-            self.client = None
-            self.use_openai_client = False
+        )
+        
+        # Pooled HTTP client reused by every direct API call (auth headers bound once)
+        self._http = httpx.AsyncClient(
+            base_url=self.base_url,
+            headers={
+                "Authorization": f"Bearer {self.api_key}",
+                "Content-Type": "application/json"
+            },
+            timeout=60.0,
+            limits=httpx.Limits(
+                max_connections=Config.PARALONCLOUD_MAX_CONCURRENCY,
+                max_keepalive_connections=Config.PARALONCLOUD_MAX_CONCURRENCY
+            ),
+            http2=True
+        )
+        
+        # Caps in-flight generation POSTs to the pool size; created on first use so it
+        # binds to the running event loop
+        self._sem = None
+        
+        # Generation endpoint that last succeeded; tried first on later calls
+        self._resolved_endpoint = None
+        
+        # LRU cache of URL generation results keyed by request parameters. Entries older
+        # than the TTL are not served directly but kept as a fallback if the API fails.
+        self._result_cache = OrderedDict()
+        self._result_cache_size = 256
+        self._result_cache_ttl = 600.0
+        # Stale entries past this age are dropped; provider URLs typically expire after an hour
+        self._result_cache_stale_ttl = 3600.0
+        
+        # In-flight generation tasks, so concurrent identical requests share one API call
+        self._inflight = {}
+        
+        # Background warmup started by schedule_warmup(); awaited by the first generation
+        self._warmup_task = None
+    
+    async def close(self):
+        """Close the pooled HTTP connections"""
+        if self._warmup_task is not None and not self._warmup_task.done():
+            self._warmup_task.cancel()
+        await self._http.aclose()
+        await self.client.close()
+    
+    async def warmup(self, timeout: float = 5.0):
+        """Open a pooled connection to the API host so the first real call skips the handshake"""
+        try:
+            await self._http.request("OPTIONS", self._resolved_endpoint or self._endpoints[0], timeout=timeout)
+        except httpx.HTTPError:
+            pass
     
-    async def generate_image(self, prompt: str, model: str = "dall-e-3", size: str = "1024x1024", quality: str = "standard", n: int = 1):
+    def schedule_warmup(self):
+        """Run warmup() in the background so it doesn't delay startup"""
+        self._warmup_task = asyncio.create_task(self.warmup())
+    
+    async def __aenter__(self):
+        return self
+    
+    async def __aexit__(self, exc_type, exc, tb):
+        await self.close()
+    
+    async def generate_image(self, prompt: str, model: str = "dall-e-3", size: str = "1024x1024", quality: str = "standard", n: int = 1, bypass_cache: bool = False):
         """
         Generate an image from a text prompt
         
@@ -33,36 +120,70 @@ class ParalonClient:
             size: Image size (e.g., "1024x1024", "1792x1024", "1024x1792")
             quality: Image quality ("standard" or "hd")
             n: Number of images to generate
+            bypass_cache: Always call the API, even if a fresh cached result exists
         
         Returns:
             List of image URLs or base64 encoded images
         """
-        # Try direct HTTP call first (more flexible for different API structures)
-        try:
-            return await self._generate_image_http(prompt, model, size, quality, n)
-        except Exception as http_error:
-            # Fall back to OpenAI client if HTTP fails
-            if self.use_openai_client and self.client:
-                try:
-                    return await self._generate_image_openai(prompt, model, size, quality, n)
-                except Exception as openai_error:
-                    # If both fail, raise the more descriptive error
-                    raise Exception(f"HTTP method failed: {str(http_error)}. OpenAI client also failed: {str(openai_error)}")
+        # Identical requests are served from the cache instead of hitting the API again
+        key = (model, prompt, size, quality, n)
+        cached = self._result_cache.get(key)
+        if cached is not None:
+            stored_at, cached_images = cached
+            age = time.monotonic() - stored_at
+            if age >= self._result_cache_stale_ttl:
+                # Too old to trust its URLs even as a fallback
+                del self._result_cache[key]
+                cached = None
             else:
-                raise http_error
+                self._result_cache.move_to_end(key)
+                if not bypass_cache and age < self._result_cache_ttl:
+                    return list(cached_images)
+        
+        try:
+            images = await self._generate_image_coalesced(key, prompt, model, size, quality, n)
+        except (TransientAPIError, httpx.TransportError):
+            # Serve the last known (stale) result during outages and exhausted rate limits;
+            # auth and validation errors still propagate
+            if cached is not None and not bypass_cache:
+                return list(cached[1])
+            raise
+        
+        # Only cache URL results; base64 payloads can be several MB each and would
+        # make a count-bounded cache grow without a meaningful memory limit
+        if all(isinstance(img, str) and img.startswith(('http://', 'https://')) for img in images):
+            self._result_cache[key] = (time.monotonic(), images)
+            self._result_cache.move_to_end(key)
+            if len(self._result_cache) > self._result_cache_size:
+                self._result_cache.popitem(last=False)
+        return list(images)
+    
+    async def _generate_image_coalesced(self, key: tuple, prompt: str, model: str, size: str, quality: str, n: int):
+        """Join an in-flight generation for the same key, or start one"""
+        task = self._inflight.get(key)
+        if task is None:
+            task = asyncio.create_task(self._generate_image_http(prompt, model, size, quality, n))
+            self._inflight[key] = task
+            task.add_done_callback(lambda _: self._inflight.pop(key, None))
+        # Shield so one caller being cancelled does not cancel the call for the others
+        return await asyncio.shield(task)
     
     async def _generate_image_http(self, prompt: str, model: str, size: str, quality: str, n: int):
-        """Generate image using direct HTTP calls"""
-        # Try different endpoint variations for ParalonCloud
-        # Note: ParalonCloud may use different endpoints than standard OpenAI
-        endpoints = [
-            f"{self.base_url}/images/generations",  # Standard OpenAI format
-            f"{self.base_url}/inference/images/generations",  # ParalonCloud inference endpoint
-            f"{self.base_url}/inference/generate",  # Alternative inference format
-            f"{self.base_url}/generate",  # Simple format
-            f"{self.base_url}/v1/generate",  # Versioned simple format
-            f"{self.base_url}/api/v1/images/generations",  # API prefix format
-        ]
+        """Generate images by POSTing to the resolved ParalonCloud endpoint"""
+        # Let a pending warmup finish so this call reuses its connection
+        if self._warmup_task is not None:
+            await asyncio.shield(self._warmup_task)
+        
+        endpoints = self._endpoints
+        
+        # Skip probing once a working endpoint is known; re-probe if it stops working.
+        # On a cold start, probe all variants at once and try the ones that exist first,
+        # keeping their original priority order.
+        if self._resolved_endpoint:
+            preferred = (self._resolved_endpoint,)
+        else:
+            preferred = await self._probe_endpoints(endpoints)
+        endpoints = preferred + tuple(e for e in endpoints if e not in preferred)
         
         payload = {
             "prompt": prompt,
@@ -75,63 +196,65 @@ class ParalonClient:
         if model == "dall-e-3":
             payload["quality"] = quality
         
-        headers = {
-            "Authorization": f"Bearer {self.api_key}",
-            "Content-Type": "application/json"
-        }
+        # Encode once; the same body is reused for every endpoint attempt
+        body = orjson.dumps(payload)
+        
+        if self._sem is None:
+            self._sem = asyncio.Semaphore(Config.PARALONCLOUD_MAX_CONCURRENCY)
         
         last_error = None
-        async with httpx.AsyncClient(timeout=60.0) as client:
-            for endpoint in endpoints:
-                try:
-                    response = await client.post(endpoint, json=payload, headers=headers)
-                    
-                    if response.status_code == 200:
-                        data = response.json()
-                        
-                        # Handle different response formats
-                        images = []
-                        if "data" in data:
-                            for img in data["data"]:
-                                if "url" in img:
-                                    images.append(img["url"])
-                                elif "b64_json" in img:
-                                    images.append(img["b64_json"])
-                        elif "images" in data:
-                            images = data["images"]
-                        elif isinstance(data, list):
-                            images = data
-                        else:
-                            # Try to extract any image URLs from the response
-                            images = [str(data)]
-                        
-                        if images:
-                            return images
-                    
-                    elif response.status_code == 404:
-                        # Try next endpoint
-                        continue
-                    else:
-                        error_text = response.text
-                        raise Exception(f"API returned status {response.status_code}: {error_text}")
-                        
-                except httpx.HTTPStatusError as e:
-                    if e.response.status_code == 404:
-                        last_error = f"Endpoint {endpoint} not found (404)"
-                        continue
-                    else:
-                        raise Exception(f"HTTP error {e.response.status_code}: {e.response.text}")
-                except Exception as e:
-                    last_error = str(e)
-                    continue
+        transport_failed = False
+        for endpoint in endpoints:
+            # Only transport failures and malformed bodies move on to the next endpoint;
+            # anything else is a real error and propagates immediately
+            try:
+                response, raw = await self._post_with_retry(endpoint, body)
+                
+                if response.status_code == 200:
+                    data = orjson.loads(raw)
+            except (httpx.ConnectError, httpx.TimeoutException, httpx.RemoteProtocolError) as e:
+                last_error = str(e)
+                transport_failed = True
+                continue
+            except orjson.JSONDecodeError as e:
+                last_error = str(e)
+                continue
+            
+            if response.status_code == 200:
+                # Handle different response formats
+                images = []
+                if "data" in data:
+                    for img in data["data"]:
+                        if "url" in img:
+                            images.append(img["url"])
+                        elif "b64_json" in img:
+                            images.append(img["b64_json"])
+                elif "images" in data:
+                    images = data["images"]
+                elif isinstance(data, list):
+                    images = data
+                else:
+                    # Try to extract any image URLs from the response
+                    images = [str(data)]
+                
+                if images:
+                    self._resolved_endpoint = endpoint
+                    return images
+            
+            elif response.status_code in self.FAILOVER_STATUS_CODES:
+                # Endpoint missing: try the next endpoint
+                last_error = f"Endpoint {endpoint} returned {response.status_code}"
+                continue
+            else:
+                # Auth, validation and exhausted rate-limit/server errors won't be fixed by a different URL
+                error_cls = TransientAPIError if response.status_code in self.RETRY_STATUS_CODES else Exception
+                raise error_cls(f"API returned status {response.status_code}: {raw.decode('utf-8', errors='replace')}")
         
         # If all endpoints failed, provide helpful error message
+        tried = "".join(f"  - {endpoint}\n" for endpoint in self._endpoints)
         error_msg = (
             f"Image generation endpoint not found. Tried endpoints:\n"
-            f"  - {self.base_url}/images/generations\n"
-            f"  - {self.base_url}/inference/images/generations\n"
-            f"  - {self.base_url}/inference/generate\n"
-            f"  - {self.base_url}/generate\n"
+            f"{tried}"
             f"\n"
             f"ParalonCloud may not support image generation through the OpenAI-compatible API, "
             f"or may use a different endpoint structure.\n"
@@ -141,35 +264,68 @@ class ParalonClient:
             f"Current base URL: {self.base_url}\n"
             f"Last error: {last_error or 'All endpoints returned 404'}"
         )
-        raise Exception(error_msg)
-    
-    async def _generate_image_openai(self, prompt: str, model: str, size: str, quality: str, n: int):
-        """Generate image using OpenAI client"""
-        loop = asyncio.get_event_loop()
-        response = await loop.run_in_executor(
-            None,
-            lambda: self.client.images.generate(
-                model=model,
-                prompt=prompt,
-                size=size,
-                quality=quality,
-                n=n
-            )
-        )
+        raise (TransientAPIError if transport_failed else Exception)(error_msg)
+    
+    async def _post_with_retry(self, endpoint: str, body: bytes):
+        """
+        POST to one endpoint, retrying rate-limit and transient server errors with backoff.
         
+        Returns the response together with its body. The body is streamed into a
+        single growing buffer, so large b64_json payloads are not held twice while
+        httpx joins the received chunks.
+        """
+        for attempt in range(self.RETRY_ATTEMPTS):
+            async with self._sem:
+                async with self._http.stream("POST", endpoint, content=body) as response:
+                    raw = bytearray()
+                    async for chunk in response.aiter_bytes():
+                        raw.extend(chunk)
+            
+            if response.status_code not in self.RETRY_STATUS_CODES or attempt == self.RETRY_ATTEMPTS - 1:
+                return response, raw
+            
+            # Sleep outside the semaphore so waiting retries don't hold a slot
+            await asyncio.sleep(self._retry_delay(response, attempt))
+    
+    def _retry_delay(self, response: httpx.Response, attempt: int) -> float:
+        """Seconds to wait before the next attempt, honouring Retry-After when present"""
+        retry_after = response.headers.get("Retry-After")
+        if retry_after:
+            try:
+                return min(float(retry_after), self.RETRY_MAX_DELAY)
+            except ValueError:
+                pass  # HTTP-date form; fall back to exponential backoff
+        return min(0.3 * 2 ** attempt + random.uniform(0, 0.3), 5.0)
+    
+    async def _probe_endpoints(self, endpoints: tuple, timeout: float = 10.0):
+        """Send OPTIONS to every endpoint concurrently and return those that exist, in priority order"""
+        results = await asyncio.gather(
+            *(self._http.request("OPTIONS", endpoint, timeout=timeout) for endpoint in endpoints),
+            return_exceptions=True
+        )
+        for result in results:
+            if isinstance(result, BaseException) and not isinstance(result, httpx.HTTPError):
+                raise result
+        # Anything but "not found" means the route is there
+        return tuple(
+            endpoint for endpoint, result in zip(endpoints, results)
+            if isinstance(result, httpx.Response) and result.status_code in (200, 204, 401, 405)
+        )
+    
+    @staticmethod
+    def _extract_images(response):
+        """Pull image URLs or base64 payloads out of an OpenAI images response"""
         if not response or not response.data:
-            raise Exception("No data returned from API")
-        
-        results = []
-        for img in response.data:
-            if hasattr(img, 'url') and img.url:
-                results.append(img.url)
-            elif hasattr(img, 'b64_json') and img.b64_json:
-                results.append(img.b64_json)
-            else:
-                results.append(str(img))
-        
-        return results if results else []
+            return []
+        # Every item shares one shape (all URLs or all base64), so pick the field once
+        key = 'url' if getattr(response.data[0], 'url', None) else 'b64_json'
+        return [getattr(img, key) for img in response.data]
+    
+    @staticmethod
+    async def _read_file(path: str):
+        """Read an upload without blocking the event loop, as an SDK (filename, bytes) tuple"""
+        async with aiofiles.open(path, "rb") as f:
+            return (os.path.basename(path), await f.read())
     
     async def edit_image(self, image_path: str, prompt: str, mask_path: str = None, model: str = "dall-e-2", size: str = "1024x1024", n: int = 1):
         """
@@ -187,29 +343,25 @@ class ParalonClient:
             List of edited image URLs or base64 encoded images
         """
         try:
-            with open(image_path, "rb") as image_file:
-                image = image_file.read()
+            image = await self._read_file(image_path)
             
             mask = None
-            if mask_path and os.path.exists(mask_path):
-                with open(mask_path, "rb") as mask_file:
-                    mask = mask_file.read()
+            if mask_path:
+                try:
+                    mask = await self._read_file(mask_path)
+                except FileNotFoundError:
+                    pass
             
-            # Run synchronous OpenAI call in thread pool
-            loop = asyncio.get_event_loop()
-            response = await loop.run_in_executor(
-                None,
-                lambda: self.client.images.edit(
-                    model=model,
-                    image=image,
-                    prompt=prompt,
-                    mask=mask,
-                    size=size,
-                    n=n
-                )
+            response = await self.client.images.edit(
+                model=model,
+                image=image,
+                prompt=prompt,
+                mask=mask,
+                size=size,
+                n=n
             )
             
-            return [img.url for img in response.data] if response.data and hasattr(response.data[0], 'url') else [img.b64_json for img in response.data] if response.data else []
+            return self._extract_images(response)
         except Exception as e:
             raise Exception(f"Error editing image: {str(e)}")
     
@@ -227,21 +379,31 @@ class ParalonClient:
             List of variation image URLs or base64 encoded images
         """
         try:
-            with open(image_path, "rb") as image_file:
-                image = image_file.read()
-            
-            # Run synchronous OpenAI call in thread pool
-            loop = asyncio.get_event_loop()
-            response = await loop.run_in_executor(
-                None,
-                lambda: self.client.images.create_variation(
-                    model=model,
-                    image=image,
-                    size=size,
-                    n=n
-                )
+            image = await self._read_file(image_path)
+            response = await self.client.images.create_variation(
+                model=model,
+                image=image,
+                size=size,
+                n=n
             )
             
-            return [img.url for img in response.data] if response.data and hasattr(response.data[0], 'url') else [img.b64_json for img in response.data] if response.data else []
+            return self._extract_images(response)
         except Exception as e:
             raise Exception(f"Error creating image variation: {str(e)}")
+
+
+_client: Optional[ParalonClient] = None
+
+def get_client() -> ParalonClient:
+    """
+    Return the process-wide ParalonClient, creating it on first use or after it was closed.
+    
+    Prefer this over constructing ParalonClient directly so the connection pool,
+    endpoint cache, result cache and concurrency limit are shared by all callers.
+    Also usable as a FastAPI dependency: Depends(get_client).
+    """
+    global _client
+    # A closed client (e.g. after an app shutdown) is replaced rather than reused
+    if _client is None or _client._http.is_closed:
+        _client = ParalonClient()
+    return _client
@@ -10,6 +10,7 @@ function ImageGenerator() {
   const [loading, setLoading] = useState(false);
   const [images, setImages] = useState([]);
   const [error, setError] = useState(null);
+  const [lastRequest, setLastRequest] = useState(null);
 
   const handleSubmit = async (e) => {
     e.preventDefault();
@@ -17,6 +18,9 @@ function ImageGenerator() {
     setError(null);
     setImages([]);
 
+    // Resubmitting the same settings means "regenerate", so skip the server-side cache
+    const requestKey = JSON.stringify([prompt, model, size, quality, n]);
+
     try {
       const formData = new FormData();
       formData.append('prompt', prompt);
@@ -24,6 +28,8 @@ function ImageGenerator() {
       formData.append('size', size);
       formData.append('quality', quality);
       formData.append('n', n);
+      formData.append('bypass_cache', requestKey === lastRequest);
+      setLastRequest(requestKey);
 
       const response = await axios.post('/api/generate', formData, {
         headers: {